@@ -2,6 +2,8 @@ import os
 
 import hydra
 import numpy as np
+import seaborn as sns
+import torch
 import torchvision
 from omegaconf import DictConfig
 from torchvision.datasets import CIFAR10
@@ -17,31 +19,64 @@ from src.plotter import (
 from src.transform import cifar10_transform
 
 
+def load_preds(path: str):
+    """Loads the model and averaged model preds from a run's preds directory
+
+    Recent runs store all epochs in a single memory-mapped preds.npy /
+    preds_average.npy pair; older runs have one {epoch}.npy /
+    {epoch}_average.npy file per epoch.
+    """
+    if os.path.isfile(os.path.join(path, "preds.npy")):
+        preds_a = np.load(os.path.join(path, "preds.npy"), mmap_mode="r")
+        preds_b = np.load(os.path.join(path, "preds_average.npy"), mmap_mode="r")
+        return preds_a, preds_b
+
+    # Legacy layout: enumerate the epoch files with a single scandir instead
+    # of a stat per epoch, preallocate from epoch 0's shape and load each
+    # file straight into its row, avoiding a list of arrays + np.stack copy
+    entries = sorted(
+        (
+            e
+            for e in os.scandir(path)
+            if e.name.endswith(".npy") and "_average" not in e.name
+        ),
+        key=lambda e: int(e.name[: -len(".npy")]),
+    )
+
+    first = np.load(entries[0].path)
+    preds_a = np.empty((len(entries),) + first.shape, dtype=first.dtype)
+    preds_b = np.empty_like(preds_a)
+    preds_a[0] = first
+    preds_b[0] = np.load(os.path.join(path, "0_average.npy"))
+    for epoch, entry in enumerate(entries[1:], start=1):
+        preds_a[epoch] = np.load(entry.path)
+        preds_b[epoch] = np.load(os.path.join(path, f"{epoch}_average.npy"))
+
+    return preds_a, preds_b
+
+
 @hydra.main(config_path="conf", config_name="plots")
 def plots(cfg: DictConfig):
     utils.display_config(cfg)
 
-    path = hydra.utils.to_absolute_path(cfg.preds_path)
-    preds_a, preds_b = [], []
-    epoch = 0
-
-    while os.path.isfile(os.path.join(path, f"{epoch}.npy")):
-        preds_a.append(np.load(os.path.join(path, f"{epoch}.npy")))
-        preds_b.append(np.load(os.path.join(path, f"{epoch}_average.npy")))
-        epoch += 1
+    # Set once for all plots, instead of re-applying the theme per figure
+    sns.set_theme(context="talk", style="darkgrid")
 
-    preds_a = np.stack(preds_a, axis=0)
-    preds_b = np.stack(preds_b, axis=0)
+    path = hydra.utils.to_absolute_path(cfg.preds_path)
+    preds_a, preds_b = load_preds(path)
 
     assert preds_a.shape == preds_b.shape, "Shape of predictions must be the same"
 
     labels = ["No EMA", "EMA"]
     iters = np.arange(len(preds_a))
 
-    plot_stability([preds_a, preds_b], labels, iters)
+    # Adjacent-epoch equalities, computed once and shared by the plots
+    diffs = [preds_a[1:] == preds_a[:-1], preds_b[1:] == preds_b[:-1]]
+
+    plot_stability([preds_a, preds_b], labels, iters, diffs=diffs)
     plot_mismatch([preds_a, preds_b], labels, iters)
     plot_misclassification([preds_a, preds_b], labels, iters)
-    top_n = plot_persistence([preds_a, preds_b], sort="stability")
+    top_n = plot_persistence([preds_a, preds_b], sort="stability", diffs=diffs)
 
     # get val set
     dataset = CIFAR10
@@ -59,11 +94,10 @@ def plots(cfg: DictConfig):
         seed=cfg.dataset.val.seed,
     )
 
-    # save top n persistence samples
+    # save top n persistence samples, batched into a single grid image
     os.makedirs("samples")
-    for i in top_n:
-        img, _ = val_set[i]
-        torchvision.utils.save_image(img, f"samples/{i}.png")
+    imgs = torch.stack([val_set[i][0] for i in top_n])
+    torchvision.utils.save_image(imgs, "samples/grid.png", nrow=len(top_n))
 
 
 if __name__ == "__main__":
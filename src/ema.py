@@ -0,0 +1,62 @@
+from typing import Optional
+
+import torch
+import torch.nn as nn
+from timm.utils import ModelEmaV2
+
+
+class ModelEma(ModelEmaV2):
+    """Model EMA with a horizontally fused update
+
+    timm's ModelEmaV2 update iterates over the state dict in Python,
+    launching one kernel per tensor; for a ResNet that is hundreds of tiny
+    kernel launches per optimizer step. Here all parameters are updated
+    with a single multi-tensor lerp and all buffers with a single
+    multi-tensor copy.
+
+    Args:
+        model: model to average
+        decay: EMA decay rate
+        device: device on which to keep the averaged model
+
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        decay: float = 0.9999,
+        device: Optional[torch.device] = None,
+    ) -> None:
+        super().__init__(model, decay=decay, device=device)
+        self.ema_params = list(self.module.parameters())
+        self.ema_buffers = list(self.module.buffers())
+        # Bypass nn.Module.__setattr__, which would register the followed
+        # model as a submodule and leak its tensors into parameters()
+        # and state_dict()
+        self.__dict__["_model_ref"] = None
+
+    def _model_tensors(self, model: nn.Module):
+        # Cache the parameter/buffer lists of the followed model, so update()
+        # does not rebuild them every iteration
+        if self._model_ref is not model:
+            self.__dict__["_model_ref"] = model
+            self._model_params = list(model.parameters())
+            self._model_buffers = list(model.buffers())
+
+        return self._model_params, self._model_buffers
+
+    def update(self, model: nn.Module) -> None:
+        model_params, model_buffers = self._model_tensors(model)
+
+        with torch.no_grad():
+            torch._foreach_lerp_(self.ema_params, model_params, 1.0 - self.decay)
+            if self.ema_buffers:
+                torch._foreach_copy_(self.ema_buffers, model_buffers)
+
+    def set(self, model: nn.Module) -> None:
+        model_params, model_buffers = self._model_tensors(model)
+
+        with torch.no_grad():
+            torch._foreach_copy_(
+                self.ema_params + self.ema_buffers, model_params + model_buffers
+            )
@@ -42,7 +42,7 @@ class Evaluator:
             self._load_from_checkpoint(checkpoint_path)
 
         # Metrics
-        self.acc_metric = AccuracyMetric(k=1)
+        self.acc_metric = AccuracyMetric(k=1, device=device)
 
     def evaluate(self) -> float:
         """Evaluates the model
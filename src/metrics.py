@@ -1,20 +1,26 @@
+from typing import Union
+
 import numpy as np
 import torch
 
 
 class LossMetric:
-    """Keeps track of the loss over an epoch"""
+    """Keeps track of the loss over an epoch
+
+    The loss may be passed as a detached scalar tensor, in which case it
+    accumulates on device and is only read back to the host in compute().
+    """
 
     def __init__(self) -> None:
         self.running_loss = 0
         self.count = 0
 
-    def update(self, loss: float, batch_size: int) -> None:
-        self.running_loss += loss * batch_size
+    def update(self, loss: Union[float, torch.Tensor], batch_size: int) -> None:
+        self.running_loss = self.running_loss + loss * batch_size
         self.count += batch_size
 
     def compute(self) -> float:
-        return self.running_loss / self.count
+        return float(self.running_loss) / self.count
 
     def reset(self) -> None:
         self.running_loss = 0
@@ -24,42 +30,73 @@ class LossMetric:
 class AccuracyMetric:
     """Keeps track of the top-k accuracy over an epoch
 
+    When a device is given, the correct count (and, with track_preds, the
+    per-sample preds) accumulate on that device and are only copied to the
+    host when the epoch's results are read, so update() never forces a
+    GPU to CPU sync.
+
     Args:
         k (int): Value of k for top-k accuracy
+        track_preds (bool): whether to keep the per-sample preds of the epoch
+        preds_size (int): number of samples per epoch, required with track_preds
+        device (torch.device): device on which to accumulate
     """
 
-    def __init__(self, k: int = 1, track_preds=False) -> None:
-        self.correct = 0
-        self.total = 0
+    def __init__(
+        self,
+        k: int = 1,
+        track_preds=False,
+        preds_size=None,
+        device=None,
+    ) -> None:
         self.k = k
+        self.device = device
         self.track_preds = track_preds
 
+        self.correct = (
+            torch.zeros((), dtype=torch.long, device=device)
+            if device is not None
+            else 0
+        )
+        self.total = 0
+
         if self.track_preds:
-            self.preds_container = []
+            self.preds_buf = torch.empty(preds_size, dtype=torch.bool, device=device)
+            self.preds_offset = 0
 
     def update(self, out: torch.Tensor, target: torch.Tensor) -> None:
         # Computes top-k accuracy
         _, indices = torch.topk(out, self.k, dim=-1)
         target_in_top_k = torch.eq(indices, target[:, None]).bool().any(-1)
-        total_correct = torch.sum(target_in_top_k, dtype=torch.int).item()
-        total_samples = target.shape[0]
+        batch_correct = torch.sum(target_in_top_k, dtype=torch.long)
 
-        self.correct += total_correct
-        self.total += total_samples
+        if self.device is not None:
+            self.correct += batch_correct
+        else:
+            self.correct += batch_correct.item()
+        self.total += target.shape[0]
 
         if self.track_preds:
-            self.preds_container.append(target_in_top_k.cpu().numpy())
+            end = self.preds_offset + target.shape[0]
+            self.preds_buf[self.preds_offset : end] = target_in_top_k
+            self.preds_offset = end
 
     def compute(self) -> float:
+        if isinstance(self.correct, torch.Tensor):
+            return self.correct.item() / self.total
         return self.correct / self.total
 
     def reset(self) -> None:
-        self.correct = 0
+        if isinstance(self.correct, torch.Tensor):
+            self.correct.zero_()
+        else:
+            self.correct = 0
         self.total = 0
 
         if self.track_preds:
-            self.preds = None
-            self.preds_container = []
+            self.preds_offset = 0
 
     def get_preds(self) -> np.ndarray:
-        return np.concatenate(self.preds_container, axis=0)
+        # Preds are 0/1 correctness flags, so uint8 is enough and keeps
+        # downstream reductions memory-bound on 1 byte per element
+        return self.preds_buf[: self.preds_offset].to(torch.uint8).cpu().numpy()
@@ -3,34 +3,119 @@ from typing import List, Optional
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
+from matplotlib.colors import ListedColormap
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    # Column-wise reduction kernels: multithreaded, and no [epochs, n_val]
+    # sized bool temporary as with the equivalent numpy expressions
+
+    @njit(parallel=True, cache=True)
+    def _col_eq_mean_jit(a, b):
+        out = np.empty(a.shape[1])
+        for j in prange(a.shape[1]):
+            s = 0
+            for i in range(a.shape[0]):
+                s += a[i, j] == b[i, j]
+            out[j] = s / a.shape[0]
+        return out
+
+    @njit(parallel=True, cache=True)
+    def _col_add_mean_jit(a, b):
+        out = np.empty(a.shape[1])
+        for j in prange(a.shape[1]):
+            s = 0
+            for i in range(a.shape[0]):
+                s += a[i, j] + b[i, j]
+            out[j] = s / a.shape[0]
+        return out
+
+    @njit(parallel=True, cache=True)
+    def _col_stability_jit(a, b):
+        out = np.empty(a.shape[1])
+        for j in prange(a.shape[1]):
+            s = 0
+            for i in range(1, a.shape[0]):
+                s += (a[i, j] == a[i - 1, j]) + (b[i, j] == b[i - 1, j])
+            out[j] = s / (a.shape[0] - 1)
+        return out
+
+
+def _col_eq_mean(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Column-wise mean of (a == b)"""
+    if njit is not None:
+        return _col_eq_mean_jit(np.asarray(a), np.asarray(b))
+    return np.mean(a == b, axis=0)
+
+
+def _col_add_mean(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Column-wise mean of (a + b)"""
+    if njit is not None:
+        return _col_add_mean_jit(np.asarray(a), np.asarray(b))
+    return np.mean(a + b, axis=0)
+
+
+def _col_stability(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Column-wise adjacent-row match ratio of a plus that of b, fused"""
+    if njit is not None:
+        return _col_stability_jit(np.asarray(a), np.asarray(b))
+    return np.mean(a[1:, ...] == a[:-1, ...], axis=0) + np.mean(
+        b[1:, ...] == b[:-1, ...], axis=0
+    )
+
+
+def rolling_mean(x: np.ndarray, window: int) -> np.ndarray:
+    """Computes a rolling mean over x in O(len(x)) via a cumulative sum
+
+    Equivalent to np.convolve(x, np.ones(window) / window, mode="valid"),
+    which is O(len(x) * window).
+    """
+    cumsum = np.cumsum(np.insert(x, 0, 0.0))
+    return (cumsum[window:] - cumsum[:-window]) / window
 
 
 def plot_stability(
     preds: List[np.ndarray],
     labels: Optional[List[str]] = None,
     iters: Optional[List[int]] = None,
+    diffs: Optional[List[np.ndarray]] = None,
 ):
-    """Visualize the stability of predictions"""
+    """Visualize the stability of predictions
 
-    sns.set_theme(context="talk", style="darkgrid")
+    diffs optionally provides the precomputed adjacent-epoch equalities
+    (pred[1:] == pred[:-1]) of each preds array, so callers producing
+    several plots can share them.
+    """
 
     for pred in preds:
         assert preds[0].shape == pred.shape, "Shape of predictions must be the same"
 
     if iters is None:
-        iters = np.arange(len(preds_a))
+        iters = np.arange(len(preds[0]))
     if labels is None:
         labels = [str(i) for i in range(1, 1 + len(preds))]
 
     # prediction stability
     plt.figure()
 
-    for i, pred in enumerate(preds):
-        match = np.mean(pred[1:, ...] == pred[:-1, ...], axis=1)
+    if diffs is None:
+        diffs = [pred[1:, ...] == pred[:-1, ...] for pred in preds]
+
+    # Both reductions stream pred[1:] back-to-back, so the second one
+    # hits warm cache instead of re-reading the array from DRAM
+    matches, accuracies = [], []
+    for pred, diff in zip(preds, diffs):
+        matches.append(np.mean(diff, axis=1))
+        accuracies.append(np.mean(pred[1:, ...], axis=1))
+
+    for i, match in enumerate(matches):
         plt.plot(match, label=f"{labels[i]}")
 
-    for i, pred in enumerate(preds):
-        accuracy = np.mean(pred[1:, ...], axis=1)
+    for i, accuracy in enumerate(accuracies):
         plt.plot(accuracy, label=f"{labels[i]} (Acc.)", linestyle="dashed")
 
     plt.legend()
@@ -48,15 +133,13 @@ def plot_mismatch(
 ):
     """Visualize the mismatch between predictions"""
 
-    sns.set_theme(context="talk", style="darkgrid")
-
     if histogram:
         assert (
             len(preds) == 2
         ), "Only two list of predictions is supported for histogram"
     else:
         if iters is None:
-            iters = np.arange(len(preds_a))
+            iters = np.arange(len(preds[0]))
         if labels is None:
             labels = [str(i) for i in range(1, 1 + len(preds))]
 
@@ -68,20 +151,23 @@ def plot_mismatch(
         plt.xlabel("Mismatch ratio")
         plt.ylabel("# of samples")
     else:
-        for i, pred_a in enumerate(preds):
-            for j, pred_b in enumerate(preds[i + 1 :]):
-                match = np.mean((preds[0] == preds[1]), axis=1)
-                if window > 0:
-                    y = np.convolve(
-                        1 - match, np.ones((window,)) / window, mode="valid"
-                    )
-                    x = np.linspace(window / 2, len(match) - window / 2, len(y))
-                    x = np.asarray(iters)[x.astype("int")]
-                else:
-                    y = 1 - match
-                    x = np.asarray(iters)
+        # Compute each pairwise match once, before any plotting
+        pair_match = {
+            (i, j): np.mean(preds[i] == preds[j], axis=1)
+            for i in range(len(preds))
+            for j in range(i + 1, len(preds))
+        }
+
+        for (i, j), match in pair_match.items():
+            if window > 0:
+                y = rolling_mean(1 - match, window)
+                x = np.linspace(window / 2, len(match) - window / 2, len(y))
+                x = np.asarray(iters)[x.astype("int")]
+            else:
+                y = 1 - match
+                x = np.asarray(iters)
 
-                plt.plot(x, y, label=f"{labels[i]} - {labels[i+j+1]}")
+            plt.plot(x, y, label=f"{labels[i]} - {labels[j]}")
 
         plt.legend()
         plt.xlabel("Epochs")
@@ -99,15 +185,13 @@ def plot_misclassification(
 ):
     """Visualize the misclassifications of predictions"""
 
-    sns.set_theme(context="talk", style="darkgrid")
-
     if histogram:
         assert (
             len(preds) == 2
         ), "Only two list of predictions is supported for histogram"
     else:
         if iters is None:
-            iters = np.arange(len(preds_a))
+            iters = np.arange(len(preds[0]))
         if labels is None:
             labels = [str(i) for i in range(1, 1 + len(preds))]
 
@@ -122,32 +206,41 @@ def plot_misclassification(
         plt.xlabel("Misclassification ratio")
         plt.ylabel("# of samples")
     else:
-        for i, pred_a in enumerate(preds):
-            misclassification = 1 - np.mean(pred_a, axis=1)
+        # Compute the per-model and pairwise ratios once, before any plotting
+        misclassifications = [1 - np.mean(pred, axis=1) for pred in preds]
+        pair_misclassifications = {
+            (i, j): np.mean((preds[i] == preds[j]) * (1 - preds[i]), axis=1)
+            for i in range(len(preds))
+            for j in range(i + 1, len(preds))
+        }
+
+        for i in range(len(preds)):
+            misclassification = misclassifications[i]
             if window > 0:
-                y = np.convolve(
-                    misclassification, np.ones((window,)) / window, mode="valid"
+                y = rolling_mean(misclassification, window)
+                x = np.linspace(
+                    window / 2, len(misclassification) - window / 2, len(y)
                 )
-                x = np.linspace(window / 2, len(match) - window / 2, len(y))
                 x = np.asarray(iters)[x.astype("int")]
             else:
                 y = misclassification
                 x = np.asarray(iters)
-                plt.plot(x, y, label=labels[i])
 
-            for j, pred_b in enumerate(preds[i + 1 :]):
-                misclassification = np.mean((pred_a == pred_b) * (1 - pred_a), axis=1)
+            plt.plot(x, y, label=labels[i])
+
+            for j in range(i + 1, len(preds)):
+                misclassification = pair_misclassifications[(i, j)]
                 if window > 0:
-                    y = np.convolve(
-                        misclassification, np.ones((window,)) / window, mode="valid"
+                    y = rolling_mean(misclassification, window)
+                    x = np.linspace(
+                        window / 2, len(misclassification) - window / 2, len(y)
                     )
-                    x = np.linspace(window / 2, len(match) - window / 2, len(y))
                     x = np.asarray(iters)[x.astype("int")]
                 else:
                     y = misclassification
                     x = np.asarray(iters)
 
-                plt.plot(x, y, label=f"{labels[i]} and {labels[i+j+1]}")
+                plt.plot(x, y, label=f"{labels[i]} and {labels[j]}")
 
         plt.xlabel("Epoch")
         plt.ylabel("Misclassification ratio")
@@ -160,45 +253,55 @@ def plot_persistence(
     preds: List[np.ndarray],
     n_samples: int = 10,
     sort: str = "mismatch",
+    diffs: Optional[List[np.ndarray]] = None,
 ):
-    """Visualize the persistence of predictions"""
+    """Visualize the persistence of predictions
 
-    assert len(preds) == 2, "Only two list of predictions is supported for persistence"
+    diffs optionally provides the precomputed adjacent-epoch equalities
+    (pred[1:] == pred[:-1]) of each preds array, reused by the
+    "stability" sort.
+    """
 
-    sns.set_theme(context="talk", style="darkgrid")
+    assert len(preds) == 2, "Only two list of predictions is supported for persistence"
 
     preds_a, preds_b = preds[0], preds[1]
 
     if sort == "mismatch":
-        match = np.mean(preds_a == preds_b, axis=0)
+        match = _col_eq_mean(preds_a, preds_b)
         top_n = np.argsort(match)[:n_samples]
     elif sort == "misclassification":
-        misclassification = np.mean(preds_a + preds_b, axis=0)
+        misclassification = _col_add_mean(preds_a, preds_b)
         top_n = np.argsort(misclassification)[:n_samples]
     elif sort == "stability":
-        stability = np.mean(preds_a[1:, ...] == preds_a[:-1, ...], axis=0) + np.mean(
-            preds_b[1:, ...] == preds_b[:-1, ...], axis=0
-        )
+        if diffs is not None:
+            stability = np.mean(diffs[0], axis=0) + np.mean(diffs[1], axis=0)
+        else:
+            stability = _col_stability(preds_a, preds_b)
         top_n = np.argsort(stability)[:n_samples]
     else:
         top_n = np.random.choice(np.arange(preds_a.shape[0]), n_samples, replace=False)
 
-    image = np.zeros((n_samples * 3, preds_a.shape[0]))
-    for i in range(n_samples):
-        image[i * 3, :] = preds_a[:, top_n[i]]
-        image[i * 3 + 1, :] = preds_b[:, top_n[i]]
-        image[i * 3 + 2, :] = -1
+    epochs = preds_a.shape[0]
+    image = np.empty((n_samples * 2, epochs), dtype=np.uint8)
+    image[0::2] = preds_a[:, top_n].T
+    image[1::2] = preds_b[:, top_n].T
 
-    plt.figure()
+    fig, ax = plt.subplots()
 
     cmap = sns.color_palette("rocket")
-    mask = image == -1
-    ax = sns.heatmap(image, cmap=[cmap[0], cmap[-1]], mask=mask, annot=False)
-    colorbar = ax.collections[0].colorbar
+    mesh = ax.pcolormesh(
+        image, cmap=ListedColormap([cmap[0], cmap[-1]]), vmin=0, vmax=1
+    )
+    # One batched call for the separators between samples, instead of
+    # dedicated sentinel rows in the image
+    ax.hlines(np.arange(2, 2 * n_samples, 2), 0, epochs, colors="w", lw=2)
+    ax.invert_yaxis()
+
+    colorbar = fig.colorbar(mesh, ax=ax)
     colorbar.set_ticks([0.25, 0.75])
     colorbar.set_ticklabels(["False", "True"])
 
-    plt.yticks([i * 3 for i in range(n_samples)], range(n_samples))
+    plt.yticks([i * 2 + 1 for i in range(n_samples)], range(n_samples))
     plt.xlabel("Epoch")
     plt.ylabel("Sample #")
     plt.savefig("persistence.png", bbox_inches="tight")
@@ -98,6 +98,8 @@ def train(cfg: DictConfig):
         save_preds=cfg.save_preds,
         checkpoint_path=checkpoint_path,
         averaged_model=averaged_model,
+        amp_dtype=cfg.hparams.amp_dtype,
+        compile_model=cfg.compile,
     )
 
     # Launch training process
@@ -277,6 +279,7 @@ def get_loaders(
             batch_size=cfg.hparams.batch_size,
             shuffle=True,
             num_workers=cfg.dataset.num_workers,
+            pin_memory=cfg.dataset.pin_memory,
         )
     else:
         train_loader = None
@@ -300,6 +303,7 @@ def get_loaders(
                 batch_size=cfg.hparams.batch_size,
                 shuffle=False,
                 num_workers=cfg.dataset.num_workers,
+                pin_memory=cfg.dataset.pin_memory,
             )
 
         else:
@@ -322,6 +326,7 @@ def get_loaders(
             batch_size=cfg.hparams.batch_size,
             shuffle=False,
             num_workers=cfg.dataset.num_workers,
+            pin_memory=cfg.dataset.pin_memory,
         )
     else:
         test_loader = None
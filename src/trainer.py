@@ -1,3 +1,4 @@
+import concurrent.futures
 import logging
 import math
 import os
@@ -15,6 +16,19 @@ from src.metrics import AccuracyMetric, LossMetric
 from src.utils import weight_diff_norm, weight_norm
 
 
+def _cpu_state_snapshot(obj: Any) -> Any:
+    """Recursively detaches, moves to CPU and clones the tensors of a state
+    object, so it can be serialized in the background while training keeps
+    mutating the originals"""
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return {k: _cpu_state_snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_state_snapshot(v) for v in obj)
+    return obj
+
+
 class Trainer:
     """Model trainer
 
@@ -34,6 +48,10 @@ class Trainer:
         checkpoint_path: path to model checkpoint, to resume training
         averaged_model: optional averaged model
         save_preds: whether to save predictions for further analysis
+        amp_dtype: mixed precision dtype, "float16" or "bfloat16"
+            (disabled if None)
+        compile_model: whether to JIT-compile the model and averaged model
+            with torch.compile
 
     """
 
@@ -54,6 +72,8 @@ class Trainer:
         checkpoint_path: Optional[str] = None,
         averaged_model: Optional[ModelEmaV2] = None,
         save_preds: bool = False,
+        amp_dtype: Optional[str] = None,
+        compile_model: bool = False,
     ) -> None:
 
         # Logging
@@ -61,17 +81,37 @@ class Trainer:
         self.writer = writer
 
         # Saving
+        # Checkpoints are snapshotted to CPU synchronously (a memcpy) and
+        # written to disk in the background, off the training critical path
         self.save_path = save_path
         self.save_preds = save_preds
+        self._save_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending_saves = []
 
         # Device
         self.device = device
 
+        # Fixed CIFAR input shapes, so let cudnn autotune its conv algorithms
+        # unless a seeded run asked for determinism, and allow TF32 matmuls
+        if not torch.backends.cudnn.deterministic:
+            torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision("high")
+
         # Data
         self.train_loader = train_loader
         self.val_loader = val_loader
 
         # Model
+        # torch.compile wraps the modules in place (the parameters are
+        # shared), so the optimizer and averaged model keep working on the
+        # same tensors
+        if compile_model:
+            model = torch.compile(model, mode="max-autotune")
+            if averaged_model is not None:
+                averaged_model.module = torch.compile(
+                    averaged_model.module, mode="reduce-overhead"
+                )
+
         self.model = model
         self.loss_fn = loss_fn
         self.optimizer = optimizer
@@ -81,21 +121,57 @@ class Trainer:
         self.epochs = epochs
         self.start_epoch = 0
 
+        # Mixed precision
+        amp_dtypes = {"float16": torch.float16, "bfloat16": torch.bfloat16}
+        if amp_dtype is not None and amp_dtype not in amp_dtypes:
+            raise ValueError(f"amp_dtype must be one of {list(amp_dtypes)} or None")
+        self.amp_dtype = amp_dtypes[amp_dtype] if amp_dtype is not None else None
+        # Loss scaling is only needed for float16
+        self.scaler = torch.cuda.amp.GradScaler(
+            enabled=(self.amp_dtype == torch.float16)
+        )
+
         # Averaged model
         self.averaged_model = averaged_model
 
+        # Preds are written in place into a single memory-mapped file per model,
+        # instead of one small file per epoch
+        if self.save_preds and self.save_path is not None and val_loader is not None:
+            preds_dir = os.path.join(self.save_path, "preds")
+            os.makedirs(preds_dir, exist_ok=True)
+            preds_shape = (self.epochs, len(val_loader.dataset))
+            self.preds_mm = np.lib.format.open_memmap(
+                os.path.join(preds_dir, "preds.npy"),
+                mode="w+",
+                dtype=np.uint8,
+                shape=preds_shape,
+            )
+            self.avg_preds_mm = np.lib.format.open_memmap(
+                os.path.join(preds_dir, "preds_average.npy"),
+                mode="w+",
+                dtype=np.uint8,
+                shape=preds_shape,
+            )
+
         if checkpoint_path:
             self._load_from_checkpoint(checkpoint_path)
 
         # Metrics
+        track_preds = self.save_preds and val_loader is not None
+        n_val = len(val_loader.dataset) if val_loader is not None else None
+
         self.train_loss_metric = LossMetric()
-        self.train_acc_metric = AccuracyMetric(k=1)
+        self.train_acc_metric = AccuracyMetric(k=1, device=device)
 
         self.val_loss_metric = LossMetric()
-        self.val_acc_metric = AccuracyMetric(k=1, track_preds=self.save_preds)
+        self.val_acc_metric = AccuracyMetric(
+            k=1, track_preds=track_preds, preds_size=n_val, device=device
+        )
 
         self.avg_model_loss_metric = LossMetric()
-        self.avg_model_acc_metric = AccuracyMetric(k=1, track_preds=self.save_preds)
+        self.avg_model_acc_metric = AccuracyMetric(
+            k=1, track_preds=track_preds, preds_size=n_val, device=device
+        )
 
         self.weight_diff = None
         self.best_val_loss = math.inf
@@ -111,10 +187,7 @@ class Trainer:
             self._train_loop(epoch)
 
             if self.val_loader is not None:
-                self._val_loop(epoch, on_averaged=False)
-
-                if self.averaged_model is not None:
-                    self._val_loop(epoch, on_averaged=True)
+                self._val_loop(epoch)
 
             epoch_time = time.time() - start_epoch_time
             self._end_loop(epoch, epoch_time)
@@ -127,6 +200,11 @@ class Trainer:
                 os.path.join(self.save_path, "final_averaged_model.pt"), self.epochs
             )
 
+        # Wait for any in-flight checkpoint writes before returning,
+        # re-raising if one of them failed
+        for future in concurrent.futures.wait(self._pending_saves).done:
+            future.result()
+
     def _train_loop(self, epoch: int) -> None:
         """
         Regular train loop
@@ -142,22 +220,30 @@ class Trainer:
         self.model.train()
 
         # Loop
-        for data, target in self.train_loader:
+        for step, (data, target) in enumerate(self.train_loader):
             # To device
-            data, target = data.to(self.device), target.to(self.device)
+            data = data.to(self.device, non_blocking=True)
+            target = target.to(self.device, non_blocking=True)
 
             # Forward + backward
-            self.optimizer.zero_grad()
-            out = self.model(data)
-            loss = self.loss_fn(out, target)
-            loss.backward()
+            self.optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(
+                self.device.type,
+                dtype=self.amp_dtype,
+                enabled=self.amp_dtype is not None,
+            ):
+                out = self.model(data)
+                loss = self.loss_fn(out, target)
+            self.scaler.scale(loss).backward()
 
             if self.grad_clip_max_norm is not None:
+                self.scaler.unscale_(self.optimizer)
                 torch.nn.utils.clip_grad_norm_(
                     self.model.parameters(), self.grad_clip_max_norm
                 )
 
-            self.optimizer.step()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
 
             # Update averaged model
             if self.averaged_model is not None:
@@ -167,13 +253,15 @@ class Trainer:
             if self.scheduler is not None and self.update_sched_on_iter:
                 self.scheduler.step()
 
-            # Update metrics
-            self.train_loss_metric.update(loss.item(), data.shape[0])
+            # Update metrics, keeping the loss on device (reading it back
+            # with .item() every iter would force a sync each iteration)
+            self.train_loss_metric.update(loss.detach(), data.shape[0])
             self.train_acc_metric.update(out, target)
 
             # Update progress bar
             pbar.update()
-            pbar.set_postfix_str(f"Loss: {loss.item():.3f}", refresh=False)
+            if step % 50 == 0:
+                pbar.set_postfix_str(f"Loss: {loss.item():.3f}", refresh=False)
 
         # Update scheduler if it is epoch-based
         if self.scheduler is not None and not self.update_sched_on_iter:
@@ -181,48 +269,58 @@ class Trainer:
 
         pbar.close()
 
-    def _val_loop(self, epoch: int, on_averaged=False) -> None:
+    def _val_loop(self, epoch: int) -> None:
         """
-        Standard validation loop
+        Standard validation loop, evaluating the model and, if present, the
+        averaged model in a single pass over the dataloader
 
         Args:
             epoch: current epoch
         """
         # Progress bar
         pbar = tqdm.tqdm(total=len(self.val_loader), leave=False)
-        if not on_averaged:
-            pbar.set_description(f"Epoch {epoch} | Validation")
-        else:
-            pbar.set_description(f"Epoch {epoch} | Averaged model validation")
+        pbar.set_description(f"Epoch {epoch} | Validation")
 
         # Set to eval
         self.model.eval()
 
         # Loop
-        for data, target in self.val_loader:
-            with torch.no_grad():
+        for step, (data, target) in enumerate(self.val_loader):
+            with torch.inference_mode():
                 # To device
-                data, target = data.to(self.device), target.to(self.device)
+                data = data.to(self.device, non_blocking=True)
+                target = target.to(self.device, non_blocking=True)
 
                 # Forward
-                if not on_averaged:
+                with torch.autocast(
+                    self.device.type,
+                    dtype=self.amp_dtype,
+                    enabled=self.amp_dtype is not None,
+                ):
                     out = self.model(data)
-                else:
-                    out = self.averaged_model.module(data)
-
-                loss = self.loss_fn(out, target)
+                    loss = self.loss_fn(out, target)
 
                 # Update metrics
-                if not on_averaged:
-                    self.val_loss_metric.update(loss.item(), data.shape[0])
-                    self.val_acc_metric.update(out, target)
-                else:
-                    self.avg_model_loss_metric.update(loss.item(), data.shape[0])
-                    self.avg_model_acc_metric.update(out, target)
+                self.val_loss_metric.update(loss.detach(), data.shape[0])
+                self.val_acc_metric.update(out, target)
+
+                # Averaged model forward, reusing the already-on-device batch
+                if self.averaged_model is not None:
+                    with torch.autocast(
+                        self.device.type,
+                        dtype=self.amp_dtype,
+                        enabled=self.amp_dtype is not None,
+                    ):
+                        avg_out = self.averaged_model.module(data)
+                        avg_loss = self.loss_fn(avg_out, target)
+
+                    self.avg_model_loss_metric.update(avg_loss.detach(), data.shape[0])
+                    self.avg_model_acc_metric.update(avg_out, target)
 
                 # Update progress bar
                 pbar.update()
-                pbar.set_postfix_str(f"Loss: {loss.item():.3f}", refresh=False)
+                if step % 50 == 0:
+                    pbar.set_postfix_str(f"Loss: {loss.item():.3f}", refresh=False)
 
         pbar.close()
 
@@ -264,15 +362,12 @@ class Trainer:
                         )
 
             # Save preds
-            if self.save_preds:
-                preds_dir = os.path.join(self.save_path, "preds")
-                os.makedirs(preds_dir, exist_ok=True)
+            if self.save_preds and self.val_loader is not None:
+                self.preds_mm[epoch] = self.val_acc_metric.get_preds()
+                self.preds_mm.flush()
 
-                preds = self.val_acc_metric.get_preds()
-                np.save(os.path.join(preds_dir, f"{epoch}"), preds)
-
-                preds_average = self.avg_model_acc_metric.get_preds()
-                np.save(os.path.join(preds_dir, f"{epoch}_average"), preds_average)
+                self.avg_preds_mm[epoch] = self.avg_model_acc_metric.get_preds()
+                self.avg_preds_mm.flush()
 
         # Clear metrics
         self.train_loss_metric.reset()
@@ -332,27 +427,47 @@ class Trainer:
                 )
 
     def _save_model(self, path, epoch):
+        # Save the original module's state dict, so checkpoint keys stay
+        # free of torch.compile's _orig_mod prefix
+        model = getattr(self.model, "_orig_mod", self.model)
         obj = {
             "epoch": epoch + 1,
-            "optimizer": self.optimizer.state_dict(),
-            "model": self.model.state_dict(),
-            "scheduler": self.scheduler.state_dict()
+            "optimizer": _cpu_state_snapshot(self.optimizer.state_dict()),
+            "model": _cpu_state_snapshot(model.state_dict()),
+            "scheduler": _cpu_state_snapshot(self.scheduler.state_dict())
             if self.scheduler is not None
             else None,
         }
-        torch.save(obj, os.path.join(self.save_path, path))
+        self._submit_save(obj, os.path.join(self.save_path, path))
 
     def _save_averaged_model(self, path, epoch):
+        module = getattr(
+            self.averaged_model.module, "_orig_mod", self.averaged_model.module
+        )
         obj = {
             "epoch": epoch + 1,
-            "model": self.averaged_model.module.state_dict(),
+            "model": _cpu_state_snapshot(module.state_dict()),
             "decay": self.averaged_model.decay,
         }
-        torch.save(obj, os.path.join(self.save_path, path))
+        self._submit_save(obj, os.path.join(self.save_path, path))
+
+    def _submit_save(self, obj, path):
+        pending = []
+        for future in self._pending_saves:
+            if future.done():
+                # Re-raise any failure from the background write, instead of
+                # silently dropping the checkpoint
+                future.result()
+            else:
+                pending.append(future)
+
+        pending.append(self._save_pool.submit(torch.save, obj, path))
+        self._pending_saves = pending
 
     def _load_from_checkpoint(self, checkpoint_path: str) -> None:
         checkpoint = torch.load(checkpoint_path, map_location=self.device)
-        self.model.load_state_dict(checkpoint["model"])
+        model = getattr(self.model, "_orig_mod", self.model)
+        model.load_state_dict(checkpoint["model"])
         self.optimizer.load_state_dict(checkpoint["optimizer"])
 
         self.start_epoch = checkpoint["epoch"]
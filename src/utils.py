@@ -72,23 +72,20 @@ def truncated_normal(size, threshold=1):
 
 def weight_diff_norm(model: nn.Module, ema_model: nn.Module) -> float:
     """Computes the L2 norm of the difference in weights between two models"""
-    l2_norm = 0
-
-    for param1, param2 in zip(model.parameters(), ema_model.parameters()):
-        l2_norm += torch.linalg.norm(param1 - param2) ** 2
-
-    l2_norm = torch.sqrt(l2_norm).item()
+    with torch.no_grad():
+        diffs = torch._foreach_sub(
+            list(model.parameters()), list(ema_model.parameters())
+        )
+        norms = torch._foreach_norm(diffs, 2)
+        l2_norm = torch.linalg.vector_norm(torch.stack(norms)).item()
 
     return l2_norm
 
 
 def weight_norm(model: nn.Module) -> float:
     """Computes the L2 norm of weights in a model"""
-    l2_norm = 0
-
-    for param in model.parameters():
-        l2_norm += torch.linalg.norm(param) ** 2
-
-    l2_norm = torch.sqrt(l2_norm).item()
+    with torch.no_grad():
+        norms = torch._foreach_norm(list(model.parameters()), 2)
+        l2_norm = torch.linalg.vector_norm(torch.stack(norms)).item()
 
     return l2_norm